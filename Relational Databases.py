@@ -1,8 +1,11 @@
-from flask import Flask, request, jsonify, abort
+from flask import Flask, Response, request, jsonify, abort, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
+from flask_caching import Cache
 from marshmallow import fields, validates, ValidationError
-from sqlalchemy import UniqueConstraint, DateTime
+from sqlalchemy import UniqueConstraint, Index, DateTime, event, select, func, exists, delete
+from sqlalchemy.orm import selectinload, raiseload
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime
 import os
 
@@ -16,25 +19,60 @@ DB_HOST = os.getenv("ECO_DB_HOST", "localhost")
 DB_NAME = os.getenv("ECO_DB_NAME", "ecommerce_api")
 
 app.config['SQLALCHEMY_DATABASE_URI'] = (
-    f"mysql+mysqlconnector://{DB_USER}:{DB_PASS}@{DB_HOST}/{DB_NAME}"
+    f"mysql+pymysql://{DB_USER}:{DB_PASS}@{DB_HOST}/{DB_NAME}"
 )
+# pool sized for several concurrent workers; pre_ping/recycle drop connections MySQL has timed out
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 20,
+    'max_overflow': 40,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    # sessions run in UTC so server-side timestamp defaults match client-supplied UTC dates
+    'connect_args': {'init_command': "SET time_zone='+00:00'"},
+}
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Make every unplanned lazy load raise instead of silently emitting a query (N+1 guard).
+# Enabled when testing or with ECO_RAISELOAD=1; routes must eager-load what they dump.
+app.config['RAISELOAD'] = os.getenv("ECO_RAISELOAD", "0") == "1"
+# cache for hot product reads; entries are dropped on every product write.
+# SimpleCache is per process - with several workers use RedisCache or MemcachedCache
+# so an invalidation reaches all of them.
+app.config['CACHE_TYPE'] = os.getenv("ECO_CACHE_TYPE", "SimpleCache")
+app.config['CACHE_DEFAULT_TIMEOUT'] = int(os.getenv("ECO_CACHE_TIMEOUT", "60"))
+if os.getenv("ECO_CACHE_REDIS_URL"):
+    app.config['CACHE_REDIS_URL'] = os.getenv("ECO_CACHE_REDIS_URL")
+if os.getenv("ECO_CACHE_MEMCACHED_SERVERS"):
+    app.config['CACHE_MEMCACHED_SERVERS'] = os.getenv("ECO_CACHE_MEMCACHED_SERVERS").split(",")
 
 # ---------- INIT ----------
 db = SQLAlchemy(app)
 ma = Marshmallow(app)
+cache = Cache(app)
+
+@event.listens_for(db.session, "do_orm_execute")
+def _raise_on_lazy_load(orm_execute_state):
+    if not (app.config['RAISELOAD'] or app.config['TESTING']):
+        return
+    # only top-level SELECTs - leave lazy/selectin/refresh loads themselves alone
+    if (orm_execute_state.is_select
+            and not orm_execute_state.is_column_load
+            and not orm_execute_state.is_relationship_load):
+        orm_execute_state.statement = orm_execute_state.statement.options(raiseload('*'))
 
 # ---------- MODELS ----------
 
 # Association table for many-to-many relationship between Orders and Products
 class OrderProduct(db.Model):
     __tablename__ = 'order_product'
-    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id', ondelete='CASCADE'), primary_key=True)
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'), primary_key=True)
     quantity = db.Column(db.Integer, nullable=False, default=1)
 
     __table_args__ = (
         UniqueConstraint('order_id', 'product_id', name='uq_order_product'),
+        # the (order_id, product_id) PK already covers lookups by order_id;
+        # this one serves the reverse lookup by product
+        Index('ix_op_product', 'product_id'),
     )
 
 class User(db.Model):
@@ -44,15 +82,20 @@ class User(db.Model):
     address = db.Column(db.String(250))
     email = db.Column(db.String(150), unique=True, nullable=False)
 
-    orders = db.relationship('Order', backref='user', cascade="all, delete-orphan")
+    # left unloaded on delete - the DB cascades to orders (and their order_product rows)
+    orders = db.relationship('Order', back_populates='user', cascade="all, delete-orphan",
+                             passive_deletes=True)
 
 class Order(db.Model):
     __tablename__ = 'orders'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    order_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # UTC, because every connection sets time_zone='+00:00' (see SQLALCHEMY_ENGINE_OPTIONS)
+    order_date = db.Column(db.DateTime, nullable=False, server_default=func.current_timestamp())
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
 
-    products = db.relationship('Product', secondary='order_product', back_populates='orders')
+    user = db.relationship('User', back_populates='orders')
+    products = db.relationship('Product', secondary='order_product', back_populates='orders',
+                               passive_deletes=True)
 
 class Product(db.Model):
     __tablename__ = 'products'
@@ -116,40 +159,84 @@ class OrderSchema(ma.SQLAlchemyAutoSchema):
 
 
 user_schema = UserSchema()
-users_schema = UserSchema(many=True)
+# list endpoints dump a trimmed field set; built once at import
+users_schema = UserSchema(many=True, only=('id', 'name', 'email'))
 
 product_schema = ProductSchema()
 products_schema = ProductSchema(many=True)
 
 order_schema = OrderSchema()
-orders_schema = OrderSchema(many=True)
+# nested products are left out of order lists (see GET /orders/<id>/products)
+orders_schema = OrderSchema(many=True, exclude=('products',))
 
 order_product_schema = OrderProductSchema()
 
 # ---------- HELPERS ----------
-def get_user_or_404(user_id):
-    user = User.query.get(user_id)
+def get_user_or_404(user_id, *options):
+    user = db.session.get(User, user_id, options=options)
     if not user:
         abort(404, description=f"User {user_id} not found")
     return user
 
-def get_product_or_404(product_id):
-    p = Product.query.get(product_id)
+def get_product_or_404(product_id, *options):
+    p = db.session.get(Product, product_id, options=options)
     if not p:
         abort(404, description=f"Product {product_id} not found")
     return p
 
-def get_order_or_404(order_id):
-    o = Order.query.get(order_id)
+def get_order_or_404(order_id, *options):
+    o = db.session.get(Order, order_id, options=options)
     if not o:
         abort(404, description=f"Order {order_id} not found")
     return o
 
+def stream_json(stmt, schema, batch_size=500):
+    # write a JSON array row by row; rows are fetched batch_size at a time.
+    # The rows come from a server-side cursor: nothing may query the same
+    # connection until it is drained, so stmt must not trigger relationship loads.
+    # the query runs here, before the 200 is sent, so DB errors still reach the 500 handler
+    rows = db.session.execute(stmt.execution_options(yield_per=batch_size)).scalars()
+
+    def gen():
+        yield '['
+        for i, row in enumerate(rows):
+            yield (',' if i else '') + app.json.dumps(schema.dump(row, many=False), separators=(',', ':'))
+        yield ']'
+    return Response(stream_with_context(gen()), mimetype='application/json')
+
+# cached payloads are plain dumped dicts, not Response objects
+@cache.cached(key_prefix="products_all")
+def products_payload():
+    products = db.session.execute(select(Product)).scalars().all()
+    return products_schema.dump(products)
+
+@cache.memoize()
+def product_payload(product_id):
+    return product_schema.dump(get_product_or_404(product_id))
+
+def invalidate_product_cache(product_id=None):
+    cache.delete("products_all")
+    if product_id is not None:
+        cache.delete_memoized(product_payload, product_id)
+
 # ---------- USER ENDPOINTS ----------
 @app.route('/users', methods=['GET'])
 def list_users():
-    users = User.query.all()
-    return jsonify(users_schema.dump(users)), 200
+    return stream_json(select(User), users_schema), 200
+
+@app.route('/users/order_counts', methods=['GET'])
+def get_order_counts():
+    # aggregated in the DB (GROUP BY uses the orders.user_id index)
+    stmt = (
+        select(User.id, User.name, func.count(Order.id))
+        .join(Order, Order.user_id == User.id)
+        .group_by(User.id, User.name)
+    )
+    rows = db.session.execute(stmt).all()
+    # names are not unique, so each user gets its own entry
+    return jsonify([
+        {"id": user_id, "name": name, "order_count": cnt} for user_id, name, cnt in rows
+    ]), 200
 
 @app.route('/users/<int:user_id>', methods=['GET'])
 def get_user(user_id):
@@ -168,14 +255,43 @@ def create_user():
     except ValidationError as err:
         return jsonify(err.messages), 400
 
-    # enforce unique email
-    if User.query.filter_by(email=data.email).first():
-        return jsonify({"message": "Email already in use"}), 400
-
+    # unique email is enforced by the DB constraint - no pre-check round-trip
     db.session.add(data)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"message": "Email already in use"}), 400
     return jsonify(user_schema.dump(data)), 201
 
+@app.route('/users/bulk', methods=['POST'])
+def create_users_bulk():
+    json_data = request.get_json()
+    if not json_data or not isinstance(json_data, list):
+        return jsonify({"message": "Expected a non-empty list of users"}), 400
+
+    # validate without building ORM instances - rows go in as plain mappings
+    errors = user_schema.validate(json_data, many=True)
+    if errors:
+        return jsonify(errors), 400
+
+    # duplicates within the payload; clashes with existing rows hit the DB constraint
+    emails = [u['email'] for u in json_data]
+    if len(set(emails)) != len(emails):
+        return jsonify({"message": "Duplicate emails in request"}), 400
+
+    # single transaction, no unit-of-work bookkeeping per row
+    try:
+        db.session.bulk_insert_mappings(User, [
+            {"name": u['name'], "email": u['email'], "address": u.get('address')}
+            for u in json_data
+        ])
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"message": "Email already in use"}), 400
+    return jsonify({"message": f"{len(json_data)} users created"}), 201
+
 @app.route('/users/<int:user_id>', methods=['PUT'])
 def update_user(user_id):
     user = get_user_or_404(user_id)
@@ -189,8 +305,6 @@ def update_user(user_id):
     email = json_data.get("email")
 
     if email and email != user.email:
-        if User.query.filter_by(email=email).first():
-            return jsonify({"message": "Email already in use"}), 400
         user.email = email
 
     if name:
@@ -198,7 +312,11 @@ def update_user(user_id):
     if address is not None:
         user.address = address
 
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"message": "Email already in use"}), 400
     return jsonify(user_schema.dump(user)), 200
 
 @app.route('/users/<int:user_id>', methods=['DELETE'])
@@ -211,13 +329,11 @@ def delete_user(user_id):
 # ---------- PRODUCT ENDPOINTS ----------
 @app.route('/products', methods=['GET'])
 def list_products():
-    products = Product.query.all()
-    return jsonify(products_schema.dump(products)), 200
+    return jsonify(products_payload()), 200
 
 @app.route('/products/<int:product_id>', methods=['GET'])
 def get_product(product_id):
-    p = get_product_or_404(product_id)
-    return jsonify(product_schema.dump(p)), 200
+    return jsonify(product_payload(product_id)), 200
 
 @app.route('/products', methods=['POST'])
 def create_product():
@@ -232,6 +348,7 @@ def create_product():
 
     db.session.add(data)
     db.session.commit()
+    invalidate_product_cache()
     return jsonify(product_schema.dump(data)), 201
 
 @app.route('/products/<int:product_id>', methods=['PUT'])
@@ -253,13 +370,16 @@ def update_product(product_id):
             return jsonify({"message": "Price must be numeric"}), 400
 
     db.session.commit()
+    invalidate_product_cache(product_id)
     return jsonify(product_schema.dump(p)), 200
 
 @app.route('/products/<int:product_id>', methods=['DELETE'])
 def delete_product(product_id):
-    p = get_product_or_404(product_id)
+    # association rows are removed through the orders collection
+    p = get_product_or_404(product_id, selectinload(Product.orders))
     db.session.delete(p)
     db.session.commit()
+    invalidate_product_cache(product_id)
     return jsonify({"message": f"Product {product_id} deleted"}), 200
 
 # ---------- ORDER ENDPOINTS ----------
@@ -280,19 +400,40 @@ def create_order():
     except ValueError:
         return jsonify({"message": "user_id must be integer"}), 400
 
-    # parse order_date if provided, else use now
+    # parse order_date if provided, else the DB stamps it (server_default)
+    order = Order(user_id=user.id)
     if order_date_raw:
         try:
             # Accept ISO format
-            order_date = datetime.fromisoformat(order_date_raw)
+            order.order_date = datetime.fromisoformat(order_date_raw)
         except Exception:
             return jsonify({"message": "order_date must be ISO datetime string (e.g. 2023-03-01T12:00:00)"}), 400
-    else:
-        order_date = datetime.utcnow()
 
-    order = Order(order_date=order_date, user_id=user.id)
-    db.session.add(order)
-    db.session.commit()
+    # optional products to attach - fetched with one IN query, not one lookup per id
+    product_ids = json_data.get('product_ids', [])
+    # bool is a subclass of int - reject JSON true/false explicitly
+    if not isinstance(product_ids, list) or not all(
+        isinstance(pid, int) and not isinstance(pid, bool) for pid in product_ids
+    ):
+        return jsonify({"message": "product_ids must be a list of integers"}), 400
+    product_ids = list(dict.fromkeys(product_ids))
+    if product_ids:
+        found = db.session.execute(select(Product.id).where(Product.id.in_(product_ids))).scalars().all()
+        missing = set(product_ids) - set(found)
+        if missing:
+            abort(404, description=f"Product(s) {sorted(missing)} not found")
+
+    # a user or product deleted after the checks above surfaces as an FK violation here
+    try:
+        db.session.add(order)
+        db.session.flush()
+        db.session.add_all([
+            OrderProduct(order_id=order.id, product_id=pid, quantity=1) for pid in product_ids
+        ])
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"message": "Referenced user or product no longer exists"}), 404
     return jsonify(order_schema.dump(order)), 201
 
 @app.route('/orders/<int:order_id>/add_product/<int:product_id>', methods=['PUT'])
@@ -300,42 +441,42 @@ def add_product_to_order(order_id, product_id):
     order = get_order_or_404(order_id)
     product = get_product_or_404(product_id)
 
-    # prevent duplicate
-    assoc = OrderProduct.query.filter_by(order_id=order.id, product_id=product.id).first()
-    if assoc:
+    # prevent duplicate (SELECT EXISTS - no row is hydrated)
+    assoc_exists = db.session.scalar(select(
+        exists().where((OrderProduct.order_id == order.id) & (OrderProduct.product_id == product.id))
+    ))
+    if assoc_exists:
         return jsonify({"message": "Product already in order"}), 400
 
     new_assoc = OrderProduct(order_id=order.id, product_id=product.id, quantity=1)
     db.session.add(new_assoc)
     db.session.commit()
-    # refresh relationship
-    db.session.refresh(order)
     return jsonify({"message": f"Product {product_id} added to order {order_id}"}), 200
 
 @app.route('/orders/<int:order_id>/remove_product/<int:product_id>', methods=['DELETE'])
 def remove_product_from_order(order_id, product_id):
-    order = get_order_or_404(order_id)
-    product = get_product_or_404(product_id)
-
-    assoc = OrderProduct.query.filter_by(order_id=order.id, product_id=product.id).first()
-    if not assoc:
-        return jsonify({"message": "Product not found in order"}), 404
-
-    db.session.delete(assoc)
+    # single DELETE; rowcount tells us whether the link existed
+    result = db.session.execute(
+        delete(OrderProduct).where(
+            (OrderProduct.order_id == order_id) & (OrderProduct.product_id == product_id)
+        )
+    )
     db.session.commit()
+    if result.rowcount == 0:
+        return jsonify({"message": "Product not found in order"}), 404
     return jsonify({"message": f"Product {product_id} removed from order {order_id}"}), 200
 
 @app.route('/orders/user/<int:user_id>', methods=['GET'])
 def get_orders_for_user(user_id):
     user = get_user_or_404(user_id)
-    orders = Order.query.filter_by(user_id=user.id).all()
-    return jsonify(orders_schema.dump(orders)), 200
+    return stream_json(select(Order).filter_by(user_id=user.id), orders_schema), 200
 
 @app.route('/orders/<int:order_id>/products', methods=['GET'])
 def get_products_for_order(order_id):
-    order = get_order_or_404(order_id)
-    # return product list for the order
-    prods = order.products
+    get_order_or_404(order_id)
+    # return product list for the order straight from the association table
+    stmt = select(Product).join(OrderProduct).where(OrderProduct.order_id == order_id)
+    prods = db.session.execute(stmt).scalars().all()
     return jsonify(products_schema.dump(prods)), 200
 
 # ---------- ERROR HANDLERS ----------
@@ -352,13 +493,17 @@ def server_error(e):
     return jsonify({"message": "An internal error occurred"}), 500
 
 # ---------- DB CREATION ----------
-@app.before_first_request
-def create_tables():
+@app.cli.command('init-db')
+def init_db():
     # create DB if not exists - MySQL must have the database created beforehand or you can create with workbench.
     # db.create_all() will create tables inside the configured database.
+    # Run once at deploy time (`flask init-db`) so requests never pay for it.
+    # Flask CLI commands already run inside an app context.
     db.create_all()
 
 # ---------- RUN ----------
 if __name__ == '__main__':
     # For development only - use gunicorn for production.
+    with app.app_context():
+        db.create_all()
     app.run(debug=True, host='0.0.0.0', port=5000)